@@ -0,0 +1,72 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from contextlib import closing
+from typing import Any, Optional
+from restructurer_math import store
+
+logger = logging.getLogger(__name__)
+
+# LLM result cache configuration. Off by default: re-running a script is usually
+# meant to produce a fresh restructure, not replay the previous one
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', '0').lower() in ('1', 'true', 'yes')
+LLM_CACHE_TTL = int(os.environ.get('LLM_CACHE_TTL', 86400))
+LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', '.llm_cache.sqlite3')
+
+# Bump when the crew prompts or output format change so stale entries are ignored
+CACHE_VERSION = 1
+
+
+_SCHEMA = "CREATE TABLE IF NOT EXISTS cache(key TEXT PRIMARY KEY, value BLOB, ts INTEGER)"
+
+
+def _connect():
+    return store.connect(LLM_CACHE_PATH, _SCHEMA)
+
+
+def make_key(inputs: dict) -> str:
+    """Compute a content-addressed cache key for a set of crew inputs."""
+    canonical = json.dumps(
+        {"v": CACHE_VERSION, **inputs},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def get(key: str) -> Optional[Any]:
+    """Return the cached value for key, or None if missing, expired or disabled."""
+    if not LLM_CACHE_ENABLED:
+        return None
+    try:
+        with closing(_connect()) as conn, conn:
+            row = conn.execute("SELECT value, ts FROM cache WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"LLM cache read error: {str(e)}")
+        return None
+
+    if row is None:
+        return None
+
+    value, ts = row
+    if LLM_CACHE_TTL > 0 and time.time() - ts > LLM_CACHE_TTL:
+        return None
+    return json.loads(value)
+
+
+def set(key: str, value: Any) -> None:
+    """Store value under key."""
+    if not LLM_CACHE_ENABLED:
+        return
+    try:
+        with closing(_connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache(key, value, ts) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), int(time.time())),
+            )
+    except sqlite3.Error as e:
+        logger.warning(f"LLM cache write error: {str(e)}")
@@ -52,6 +52,9 @@ class Restructure():
             config=self.tasks_config['restructure_answers_task'], # type: ignore[index]
         )
 
+    # mark_allocation_task marks the JSON produced by restructure_answers_task
+    # (declared via `context` in tasks.yaml), so it must stay synchronous;
+    # async_execution would let it start before its input exists.
     @task
     def mark_allocation_task(self) -> Task:
         return Task(
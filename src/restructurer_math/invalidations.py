@@ -0,0 +1,35 @@
+import time
+import sqlite3
+import logging
+from contextlib import closing
+from restructurer_math import jobs, store
+
+logger = logging.getLogger(__name__)
+
+# Cache invalidation markers, kept in the job store's database, which every
+# server worker and job process on the host already shares
+_SCHEMA = "CREATE TABLE IF NOT EXISTS invalidations(key TEXT PRIMARY KEY, ts REAL)"
+
+
+def _connect():
+    return store.connect(jobs.JOBS_DB_PATH, _SCHEMA)
+
+
+def mark(key: str) -> None:
+    """Record that entries cached under key before now are stale."""
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO invalidations(key, ts) VALUES (?, ?)",
+            (key, time.time()),
+        )
+
+
+def last_marked(key: str) -> float:
+    """Return when key was last invalidated, or 0.0 if never (or on a read error)."""
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute("SELECT ts FROM invalidations WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Invalidations read error: {str(e)}")
+        return 0.0
+    return row[0] if row else 0.0
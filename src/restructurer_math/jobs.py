@@ -0,0 +1,81 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from contextlib import closing
+from typing import Any, Optional
+from restructurer_math import store
+
+logger = logging.getLogger(__name__)
+
+# Background restructure job store, shared by all server worker processes on the host
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH', '.restructure_jobs.sqlite3')
+JOBS_TTL = int(os.environ.get('JOBS_TTL', 86400))
+
+PENDING = "pending"
+SUCCESS = "success"
+ERROR = "error"
+
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS jobs("
+    "job_id TEXT PRIMARY KEY, subject_id TEXT, script_id TEXT, "
+    "status TEXT, message TEXT, result BLOB, ts INTEGER)"
+)
+
+
+def _connect():
+    return store.connect(JOBS_DB_PATH, _SCHEMA)
+
+
+def create(job_id: str, subject_id: str, script_id: str) -> None:
+    """Record a new pending job and prune jobs older than JOBS_TTL."""
+    now = int(time.time())
+    with closing(_connect()) as conn, conn:
+        conn.execute("DELETE FROM jobs WHERE ts < ?", (now - JOBS_TTL,))
+        conn.execute(
+            "INSERT INTO jobs(job_id, subject_id, script_id, status, message, result, ts) "
+            "VALUES (?, ?, ?, ?, ?, NULL, ?)",
+            (job_id, subject_id, script_id, PENDING, "Restructure queued", now),
+        )
+
+
+def finish(job_id: str, success: bool, message: str, result: Any) -> None:
+    """Store the outcome of a job."""
+    try:
+        with closing(_connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, message = ?, result = ?, ts = ? WHERE job_id = ?",
+                (
+                    SUCCESS if success else ERROR,
+                    message,
+                    json.dumps(result, ensure_ascii=False) if result is not None else None,
+                    int(time.time()),
+                    job_id,
+                ),
+            )
+    except sqlite3.Error as e:
+        logger.error(f"Failed to record result for job {job_id}: {str(e)}")
+
+
+def get(job_id: str) -> Optional[dict]:
+    """Return the job record for job_id, or None if it is unknown."""
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT subject_id, script_id, status, message, result FROM jobs WHERE job_id = ?",
+            (job_id,),
+        ).fetchone()
+
+    if row is None:
+        return None
+
+    subject_id, script_id, status, message, result = row
+    return {
+        "job_id": job_id,
+        "subject_id": subject_id,
+        "script_id": script_id,
+        "status": status,
+        "message": message,
+        "result": json.loads(result) if result is not None else None,
+    }
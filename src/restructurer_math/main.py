@@ -1,13 +1,39 @@
 #!/usr/bin/env python
-import sys
 import os
+import multiprocessing
+
+# Under the production gevent server, patch blocking I/O before requests is imported
+# (but not in restructure job worker processes, which run plain blocking code)
+if os.environ.get('PROD') == '1' and multiprocessing.parent_process() is None:
+    from gevent import monkey
+    monkey.patch_all()
+
 import warnings
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
+from cachetools import TTLCache
+import io
 import json
+import queue
+import sqlite3
+import operator
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache, partial
+from itertools import repeat
+import orjson
+import ijson
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from restructurer_math.crew import Restructure
+from restructurer_math import cache, invalidations, jobs
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -19,6 +45,36 @@ warnings.filterwarnings("ignore", category=SyntaxWarning)
 # Django API configuration
 DJANGO_API_BASE_URL = "https://transback.transpoze.ai"
 
+# JSON is decoded with orjson; its JSONDecodeError subclasses the stdlib one
+JSONDecodeError = (orjson.JSONDecodeError, json.JSONDecodeError)
+
+# Shared HTTP session so every Django API call reuses pooled keep-alive connections
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=100,
+    max_retries=Retry(
+        total=3,
+        connect=2,
+        read=2,
+        backoff_factor=0.25,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset({'GET', 'PUT', 'POST'}),
+        raise_on_status=False,
+    ),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+SESSION.headers.update({'Content-Type': 'application/json', 'Connection': 'keep-alive'})
+
+# (connect, read) timeouts so a hung Django API cannot pin a worker forever
+DEFAULT_TIMEOUT = (3.05, 30)
+
+def _request(method: str, url: str, **kwargs):
+    """Send a request on the shared session, applying the default timeout."""
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    return SESSION.request(method, url, **kwargs)
+
 # ---
 # ### 🔍 Function to Retrieve Answer Sheet Data from OCR Endpoint
 # ---
@@ -30,56 +86,66 @@ def get_answersheet_from_ocr(script_id: str):
         url = f"{DJANGO_API_BASE_URL}/ocr/?script_id={script_id}"
         logger.info(f"OCR API URL: {url}")         
         
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
+        with _request('GET', url, stream=True) as response:
+            if response.status_code != 200:
+                logger.error(f"OCR API error: {response.status_code} - {response.text}")
+                return None, None, f"OCR API error: {response.status_code} - {response.text}"
             
-            if isinstance(data, list) and len(data) > 0:
-                # Combine all pages' OCR data into a single answer sheet
-                combined_answersheet = ""
-                combined_structured_data = {}
-                
-                # Sort by page number to maintain order
-                sorted_data = sorted(data, key=lambda x: x.get('page_number', 0))
-                
-                for page_data in sorted_data:
-                    page_number = page_data.get('page_number', 0)
-                    ocr_json = page_data.get('ocr_json', {})
-                    structured_json = page_data.get('structured_json', {})
-                    context = page_data.get('context', '')
-                    
-                    # Extract text from OCR JSON (adjust based on your OCR format)
-                    page_text = extract_text_from_ocr_json(ocr_json)
-                    
-                    # Add page separator and content
-                    if combined_answersheet:
-                        combined_answersheet += f"\n\n--- Page {page_number} ---\n"
-                    else:
-                        combined_answersheet += f"--- Page {page_number} ---\n"
-                    
-                    combined_answersheet += page_text
-                    
-                    # Add context if available
-                    if context:
-                        combined_answersheet += f"\n[Context: {context}]"
-                    
-                    # Combine structured data
-                    combined_structured_data[f"page_{page_number}"] = structured_json
-                
-                if combined_answersheet:
-                    logger.info(f"Successfully combined OCR data from {len(sorted_data)} pages for script_id: {script_id}")
-                    return combined_answersheet, combined_structured_data, None
-                else:
-                    return None, None, f"No text content found in OCR data for script_id: {script_id}"
+            # Parse pages one at a time from the response stream and reduce each
+            # to its text right away, so raw OCR JSON for every page is never
+            # held in memory at once
+            response.raw.decode_content = True
+            pages = []
+            for page_data in ijson.items(response.raw, 'item', use_float=True):
+                pages.append((
+                    page_data.get('page_number', 0),
+                    extract_text_from_ocr_json(page_data.get('ocr_json', {})),
+                    page_data.get('context', ''),
+                    page_data.get('structured_json', {}),
+                ))
+        
+        if not pages:
+            return None, None, f"No OCR records found for script_id: {script_id}"
+        
+        # Combine all pages' OCR data into a single answer sheet
+        answersheet_parts = []
+        combined_structured_data = {}
+        
+        # Sort by page number to maintain order
+        pages.sort(key=_page_number)
+        
+        for page_number, page_text, context, structured_json in pages:
+            # Add page separator and content
+            if answersheet_parts:
+                answersheet_parts.append(f"\n\n--- Page {page_number} ---\n")
             else:
-                return None, None, f"No OCR records found for script_id: {script_id}"
+                answersheet_parts.append(f"--- Page {page_number} ---\n")
+            
+            answersheet_parts.append(page_text)
+            
+            # Add context if available
+            if context:
+                answersheet_parts.append(f"\n[Context: {context}]")
+            
+            # Combine structured data
+            combined_structured_data[f"page_{page_number}"] = structured_json
+        
+        combined_answersheet = "".join(answersheet_parts)
+        if combined_answersheet:
+            logger.info(f"Successfully combined OCR data from {len(pages)} pages for script_id: {script_id}")
+            return combined_answersheet, combined_structured_data, None
         else:
-            logger.error(f"OCR API error: {response.status_code} - {response.text}")
-            return None, None, f"OCR API error: {response.status_code} - {response.text}"
-    except requests.exceptions.RequestException as e:
+            return None, None, f"No text content found in OCR data for script_id: {script_id}"
+    # Streaming reads response.raw directly, so mid-stream timeouts and resets
+    # surface as urllib3 errors rather than requests exceptions
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, ijson.JSONError) as e:
         logger.error(f"OCR API request error: {str(e)}")
         return None, None, f"OCR API request error: {str(e)}"
 
+_get_text = operator.methodcaller('get', 'text')
+# Sort key for (page_number, page_text, context, structured_json) page records
+_page_number = operator.itemgetter(0)
+
 def extract_text_from_ocr_json(ocr_json):
     """Extract readable text from OCR JSON data."""
     try:
@@ -108,7 +174,7 @@ def extract_text_from_ocr_json(ocr_json):
             elif 'lines' in ocr_json:
                 lines = ocr_json['lines']
                 if isinstance(lines, list):
-                    return '\n'.join([str(line.get('text', '')) for line in lines if line.get('text')])
+                    return '\n'.join(str(text) for text in map(_get_text, lines) if text)
             
             # Fallback: try to extract any text-like values
             else:
@@ -127,14 +193,11 @@ def extract_text_from_ocr_json(ocr_json):
 def extract_from_textract_format(ocr_json):
     """Extract text from AWS Textract format."""
     try:
-        blocks = ocr_json.get('Blocks', [])
-        text_blocks = []
-        
-        for block in blocks:
-            if block.get('BlockType') == 'LINE' and 'Text' in block:
-                text_blocks.append(block['Text'])
-        
-        return '\n'.join(text_blocks)
+        return '\n'.join(
+            block['Text']
+            for block in ocr_json.get('Blocks', ())
+            if block.get('BlockType') == 'LINE' and 'Text' in block
+        )
     except Exception as e:
         logger.warning(f"Error extracting from Textract format: {str(e)}")
         return ""
@@ -151,121 +214,158 @@ def extract_from_google_vision_format(ocr_json):
         logger.warning(f"Error extracting from Google Vision format: {str(e)}")
         return ""
 
+# Keys that are likely metadata rather than text
+_SKIP_KEYS = frozenset({'id', 'type', 'confidence', 'bbox', 'coordinates'})
+
+# Handlers for decoded JSON values in extract_text_recursively. Each returns
+# True if it pushed the value's children onto the stack for the walk to descend
+def _handle_str(key, value, depth, max_depth, text_parts, stack):
+    """Collect a non-empty string unless its key is likely metadata."""
+    value = value.strip()
+    if value and (key is None or key.lower() not in _SKIP_KEYS):
+        text_parts.append(value)
+    return False
+
+def _handle_dict(key, value, depth, max_depth, text_parts, stack):
+    """Descend into a dict's (key, value) pairs if within max_depth."""
+    if depth + 1 < max_depth:
+        stack.append((iter(value.items()), depth + 1))
+        return True
+    return False
+
+def _handle_list(key, value, depth, max_depth, text_parts, stack):
+    """Descend into a list's items, which have no key, if within max_depth."""
+    if depth + 1 < max_depth:
+        stack.append((zip(repeat(None), value), depth + 1))
+        return True
+    return False
+
+# Exact-type dispatch; parsed JSON values are always exactly dict/list/str
+_HANDLERS = {str: _handle_str, dict: _handle_dict, list: _handle_list}
+
+@lru_cache(maxsize=None)
+def _handler_for(value_type):
+    """Find the handler for a type outside _HANDLERS, e.g. a str/dict/list subclass."""
+    for base, handler in _HANDLERS.items():
+        if issubclass(value_type, base):
+            return handler
+    return None
+
 def extract_text_recursively(data, max_depth=3, current_depth=0):
-    """Recursively extract text from nested JSON structures."""
+    """Extract text from nested JSON structures, up to max_depth levels deep."""
     if current_depth >= max_depth:
         return ""
+    if isinstance(data, dict):
+        children = iter(data.items())
+    elif isinstance(data, list):
+        children = zip(repeat(None), data)
+    else:
+        return ""
     
     text_parts = []
+    # Depth-first walk with an explicit stack of child iterators so text is
+    # collected in document order without recursive calls
+    stack = [(children, current_depth)]
     
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if isinstance(value, str) and len(value.strip()) > 0:
-                # Skip keys that are likely metadata
-                if key.lower() not in ['id', 'type', 'confidence', 'bbox', 'coordinates']:
-                    text_parts.append(value.strip())
-            elif isinstance(value, (dict, list)):
-                nested_text = extract_text_recursively(value, max_depth, current_depth + 1)
-                if nested_text:
-                    text_parts.append(nested_text)
-    
-    elif isinstance(data, list):
-        for item in data:
-            if isinstance(item, str) and len(item.strip()) > 0:
-                text_parts.append(item.strip())
-            elif isinstance(item, (dict, list)):
-                nested_text = extract_text_recursively(item, max_depth, current_depth + 1)
-                if nested_text:
-                    text_parts.append(nested_text)
+    while stack:
+        children, depth = stack[-1]
+        for key, value in children:
+            value_type = type(value)
+            handler = _HANDLERS.get(value_type) or _handler_for(value_type)
+            if handler is not None and handler(key, value, depth, max_depth, text_parts, stack):
+                break
+        else:
+            stack.pop()
     
     return '\n'.join(text_parts)
 
 # ---
-# ### 🔍 Function to Retrieve VLMDesc from Compare-Text Endpoint
+# ### 🔍 Function to Retrieve VLMDesc and MCQ from Compare-Text Endpoint
 # ---
-def get_vlmdesc_data(script_id: str):
-    """Retrieve vlmdesc from Django API using compare-text endpoint."""
+def get_compare_text_data(script_id: str):
+    """Retrieve vlmdesc and mcq from Django API using a single compare-text request."""
     try:
-        logger.info(f"Requesting vlmdesc for script_id: {script_id}")
+        logger.info(f"Requesting vlmdesc and mcq for script_id: {script_id}")
         
         url = f"{DJANGO_API_BASE_URL}/compare-text/?script_id={script_id}"
         
-        response = requests.get(url)
+        response = _request('GET', url)
         if response.status_code == 200:
-            data = response.json()
+            data = orjson.loads(response.content)
             
             if isinstance(data, list) and len(data) > 0:
                 latest_record = data[0]
                 vlmdesc = latest_record.get('vlmdesc')
+                mcq = latest_record.get('mcq')
                 
                 if vlmdesc:
                     logger.info(f"Found vlmdesc for script_id: {script_id}")
-                    return vlmdesc, None
                 else:
                     logger.warning(f"No vlmdesc found for script_id: {script_id}")
-                    return {}, None
-            else:
-                logger.warning(f"No compare text records found for script_id: {script_id}")
-                return {}, None
-        else:
-            logger.error(f"Compare-text API error for vlmdesc: {response.status_code} - {response.text}")
-            return {}, f"Compare-text API error: {response.status_code} - {response.text}"
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Compare-text API request error for vlmdesc: {str(e)}")
-        return {}, f"Compare-text API request error: {str(e)}"
-
-# ---
-# ### 🔍 Function to Retrieve MCQ from Compare-Text Endpoint
-# ---
-def get_mcq_data(script_id: str):
-    """Retrieve mcq from Django API using compare-text endpoint."""
-    try:
-        logger.info(f"Requesting mcq for script_id: {script_id}")
-        
-        url = f"{DJANGO_API_BASE_URL}/compare-text/?script_id={script_id}"
-        
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            
-            if isinstance(data, list) and len(data) > 0:
-                latest_record = data[0]
-                mcq = latest_record.get('mcq')
                 
                 if mcq:
                     logger.info(f"Found mcq for script_id: {script_id}")
-                    return mcq, None
                 else:
                     logger.warning(f"No mcq found for script_id: {script_id}")
-                    return {}, None
+                
+                return vlmdesc or {}, mcq or {}, None
             else:
                 logger.warning(f"No compare text records found for script_id: {script_id}")
-                return {}, None
+                return {}, {}, None
         else:
-            logger.error(f"Compare-text API error for mcq: {response.status_code} - {response.text}")
-            return {}, f"Compare-text API error: {response.status_code} - {response.text}"
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Compare-text API request error for mcq: {str(e)}")
-        return {}, f"Compare-text API request error: {str(e)}"
+            logger.error(f"Compare-text API error: {response.status_code} - {response.text}")
+            return {}, {}, f"Compare-text API error: {response.status_code} - {response.text}"
+    except (requests.exceptions.RequestException, JSONDecodeError) as e:
+        logger.error(f"Compare-text API request error: {str(e)}")
+        return {}, {}, f"Compare-text API request error: {str(e)}"
 
 # ---
 # ### 🔍 Function to Retrieve Rubrics from Key-OCR Endpoint
 # ---
+# Rubrics belong to the subject and change rarely, so they are cached per subject_id
+# as (rubrics, fetched_at). The cache is per process; invalidations are recorded
+# in a database shared by every process, which checks it before using an entry.
+RUBRICS_CACHE_TTL = int(os.environ.get('RUBRICS_CACHE_TTL', 300))
+_RUBRICS_CACHE = TTLCache(maxsize=1024, ttl=RUBRICS_CACHE_TTL)
+_RUBRICS_CACHE_LOCK = threading.Lock()
+
+def _rubrics_invalidation_key(subject_id: str):
+    return f"rubrics:{subject_id}"
+
+def invalidate_rubrics_cache(subject_id: str):
+    """Mark cached rubrics for subject_id as stale in every server and job process."""
+    invalidations.mark(_rubrics_invalidation_key(subject_id))
+    with _RUBRICS_CACHE_LOCK:
+        _RUBRICS_CACHE.pop(subject_id, None)
+
 def get_rubrics_from_keyocr(subject_id: str):
     """Retrieve rubrics from Django API using key-ocr endpoint."""
+    with _RUBRICS_CACHE_LOCK:
+        cached = _RUBRICS_CACHE.get(subject_id)
+    if cached is not None:
+        cached_rubrics, fetched_at = cached
+        if invalidations.last_marked(_rubrics_invalidation_key(subject_id)) < fetched_at:
+            logger.info(f"Using cached rubrics for subject_id: {subject_id}")
+            return cached_rubrics, None
+        logger.info(f"Cached rubrics for subject_id: {subject_id} were invalidated, refetching")
+    
+    # Taken before the request so an invalidation during the fetch still applies
+    fetched_at = time.time()
     try:
         logger.info(f"Requesting rubrics for subject_id: {subject_id}")
         
         url = f"{DJANGO_API_BASE_URL}/key-ocr/?subject_id={subject_id}"
         
-        response = requests.get(url)
+        response = _request('GET', url)
         if response.status_code == 200:
-            data = response.json()
+            data = orjson.loads(response.content)
             
             if isinstance(data, dict):
                 rubrics = data.get('rubrics', '')
                 if rubrics:
                     logger.info(f"Found rubrics for subject_id: {subject_id}")
+                    with _RUBRICS_CACHE_LOCK:
+                        _RUBRICS_CACHE[subject_id] = (rubrics, fetched_at)
                     return rubrics, None
                 else:
                     return None, f"No rubrics found for subject_id: {subject_id}"
@@ -274,7 +374,7 @@ def get_rubrics_from_keyocr(subject_id: str):
         else:
             logger.error(f"Key-OCR API error: {response.status_code} - {response.text}")
             return None, f"Key-OCR API error: {response.status_code} - {response.text}"
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, JSONDecodeError) as e:
         logger.error(f"Key-OCR API request error: {str(e)}")
         return None, f"Key-OCR API request error: {str(e)}"
 
@@ -296,10 +396,10 @@ def save_result_to_database(script_id: str, restructured_data: dict):
             "analytics": {}  # Initialize empty - will be filled by analytics service
         }
         
-        response = requests.post(url, json=payload, headers={'Content-Type': 'application/json'})
+        response = _request('POST', url, data=orjson.dumps(payload))
         
         if response.status_code == 200:
-            result_data = response.json()
+            result_data = orjson.loads(response.content)
             logger.info(f"Successfully saved result to database: {result_data}")
             return True, result_data, None
         else:
@@ -313,40 +413,66 @@ def save_result_to_database(script_id: str, restructured_data: dict):
         logger.error(f"Unexpected error saving to database: {str(e)}")
         return False, None, f"Unexpected error saving to database: {str(e)}"
 
-def update_result_in_database(script_id: str, restructured_data: dict):
-    """Update existing result in the Django database."""
+# script_id -> result_id, so repeat saves for a script skip the lookup request
+RESULT_ID_CACHE_TTL = int(os.environ.get('RESULT_ID_CACHE_TTL', 3600))
+_RESULT_ID_CACHE = TTLCache(maxsize=4096, ttl=RESULT_ID_CACHE_TTL)
+_RESULT_ID_CACHE_LOCK = threading.Lock()
+
+def _remember_result_id(script_id: str, result_id):
+    with _RESULT_ID_CACHE_LOCK:
+        if result_id is None:
+            _RESULT_ID_CACHE.pop(script_id, None)
+        else:
+            _RESULT_ID_CACHE[script_id] = result_id
+
+def find_result_id(script_id: str):
+    """Look up the result_id of an existing result for script_id, if any."""
+    with _RESULT_ID_CACHE_LOCK:
+        cached_result_id = _RESULT_ID_CACHE.get(script_id)
+    if cached_result_id is not None:
+        return cached_result_id, None
+    
     try:
-        logger.info(f"Updating result in database for script_id: {script_id}")
-        
-        # First, get the result_id for this script
         get_url = f"{DJANGO_API_BASE_URL}/results/?script_id={script_id}"
-        get_response = requests.get(get_url)
+        get_response = _request('GET', get_url)
         
         if get_response.status_code == 200:
-            results = get_response.json()
+            results = orjson.loads(get_response.content)
             if isinstance(results, list) and len(results) > 0:
                 result_id = results[0]['result_id']
-                
-                # Update the result
-                update_url = f"{DJANGO_API_BASE_URL}/results/"
-                payload = {
-                    "result_id": result_id,
-                    "restructuredtext": restructured_data
-                }
-                
-                response = requests.put(update_url, json=payload, headers={'Content-Type': 'application/json'})
-                
-                if response.status_code == 200:
-                    result_data = response.json()
-                    logger.info(f"Successfully updated result in database: {result_data}")
-                    return True, result_data, None
-                else:
-                    logger.error(f"Database update error: {response.status_code} - {response.text}")
-                    return False, None, f"Database update error: {response.status_code} - {response.text}"
-            else:
-                return False, None, f"No existing result found for script_id: {script_id}"
+                _remember_result_id(script_id, result_id)
+                return result_id, None
+            return None, None
         else:
-            return False, None, f"Error fetching existing result: {get_response.status_code} - {get_response.text}"
+            return None, f"Error fetching existing result: {get_response.status_code} - {get_response.text}"
+    
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Result lookup request error: {str(e)}")
+        return None, f"Result lookup request error: {str(e)}"
+    except Exception as e:
+        logger.error(f"Unexpected error looking up result: {str(e)}")
+        return None, f"Unexpected error looking up result: {str(e)}"
+
+def update_result_in_database(result_id, restructured_data: dict):
+    """Update existing result in the Django database."""
+    try:
+        logger.info(f"Updating result in database for result_id: {result_id}")
+        
+        update_url = f"{DJANGO_API_BASE_URL}/results/"
+        payload = {
+            "result_id": result_id,
+            "restructuredtext": restructured_data
+        }
+        
+        response = _request('PUT', update_url, data=orjson.dumps(payload))
+        
+        if response.status_code == 200:
+            result_data = orjson.loads(response.content)
+            logger.info(f"Successfully updated result in database: {result_data}")
+            return True, result_data, None
+        else:
+            logger.error(f"Database update error: {response.status_code} - {response.text}")
+            return False, None, f"Database update error: {response.status_code} - {response.text}"
     
     except requests.exceptions.RequestException as e:
         logger.error(f"Database update request error: {str(e)}")
@@ -355,17 +481,66 @@ def update_result_in_database(script_id: str, restructured_data: dict):
         logger.error(f"Unexpected error updating database: {str(e)}")
         return False, None, f"Unexpected error updating database: {str(e)}"
 
+def upsert_result(script_id: str, restructured_data: dict):
+    """Create or update the result for script_id.
+
+    Looks up an existing result first and then issues one write, instead of
+    attempting a create that fails for re-runs before updating. If the
+    create fails because a concurrent run created the result in between,
+    the result is looked up again and updated. An update on a cached
+    result_id that fails (e.g. the result was deleted) is retried from an
+    uncached lookup before the save is reported as failed.
+    Returns (success, operation, result_data, error) where operation is
+    "created", "updated" or "failed".
+    """
+    with _RESULT_ID_CACHE_LOCK:
+        cached_result_id = _RESULT_ID_CACHE.get(script_id)
+    if cached_result_id is not None:
+        success, result_data, error = update_result_in_database(cached_result_id, restructured_data)
+        if success:
+            return True, "updated", result_data, None
+        logger.warning(f"Update of cached result_id {cached_result_id} failed for script_id: {script_id}, looking it up again")
+        _remember_result_id(script_id, None)
+    
+    # With no cache entry left, this is a fresh lookup
+    result_id, lookup_error = find_result_id(script_id)
+    if lookup_error:
+        return False, "failed", None, lookup_error
+    
+    if result_id is None:
+        success, result_data, error = save_result_to_database(script_id, restructured_data)
+        operation = "created"
+        if success and isinstance(result_data, dict):
+            _remember_result_id(script_id, result_data.get('result_id'))
+        elif not success:
+            result_id, _ = find_result_id(script_id)
+            if result_id is not None:
+                logger.info(f"Create failed but a result now exists for script_id: {script_id}, updating it")
+    
+    if result_id is not None:
+        success, result_data, error = update_result_in_database(result_id, restructured_data)
+        operation = "updated"
+        if not success:
+            _remember_result_id(script_id, None)
+    
+    return success, operation if success else "failed", result_data, error
+
 # ---
 # ### 🎯 Function to Format Result as Question-Answer Pairs
 # ---
 def format_as_qa_pairs(result_text):
     """Format the restructure result as question-answer pairs."""
+    processed_at = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
     try:
-        # Try to parse as JSON first
+        # Try to parse as JSON first, but only if it looks like a JSON object or array
         if isinstance(result_text, str):
-            try:
-                result_json = json.loads(result_text)
-            except json.JSONDecodeError:
+            result_json = None
+            if result_text.lstrip()[:1] in ('{', '['):
+                try:
+                    result_json = orjson.loads(result_text)
+                except JSONDecodeError:
+                    pass
+            if result_json is None:
                 # If not JSON, treat as plain text and create a simple structure
                 result_json = {"content": result_text}
         else:
@@ -416,7 +591,7 @@ def format_as_qa_pairs(result_text):
             "qa_pairs": qa_pairs,
             "formatted_display": format_qa_display(qa_pairs),
             "metadata": {
-                "processed_at": str(json.dumps({"timestamp": "now"})),
+                "processed_at": processed_at,
                 "processing_method": "restructure_crew",
                 "data_sources": ["ocr", "vlmdesc", "mcq", "rubrics"]
             }
@@ -429,58 +604,105 @@ def format_as_qa_pairs(result_text):
             "qa_pairs": [{"question": "Restructured Content", "answer": str(result_text)}],
             "formatted_display": f"Q: Restructured Content\nA: {str(result_text)}",
             "metadata": {
-                "processed_at": str(json.dumps({"timestamp": "now"})),
+                "processed_at": processed_at,
                 "processing_method": "restructure_crew",
                 "error": str(e)
             }
         }
 
+_EQ = '=' * 60
+_DASH = '-' * 60
+
 def format_qa_display(qa_pairs):
     """Create a formatted display string for Q&A pairs."""
-    display_lines = []
+    buf = io.StringIO()
     
     for i, pair in enumerate(qa_pairs, 1):
-        display_lines.append(f"\n{'='*60}")
-        display_lines.append(f"Question {i}:")
-        display_lines.append(f"{'='*60}")
-        display_lines.append(pair["question"])
-        display_lines.append(f"\n{'-'*60}")
-        display_lines.append("Answer:")
-        display_lines.append(f"{'-'*60}")
-        display_lines.append(pair["answer"])
+        buf.write(f"\n{_EQ}\nQuestion {i}:\n{_EQ}\n{pair['question']}\n")
+        buf.write(f"\n{_DASH}\nAnswer:\n{_DASH}\n{pair['answer']}\n")
     
-    display_lines.append(f"\n{'='*60}")
+    buf.write(f"\n{_EQ}")
     
-    return "\n".join(display_lines)
+    return buf.getvalue()
+
+# ---
+# ### 🤖 Warm Crew Pool
+# ---
+# kickoff() interpolates the inputs into the crew's agents and tasks, so one
+# crew must not serve two requests at once. Crews are built on demand and
+# returned to this pool after use, so steady-state requests skip setup.
+_CREW_POOL = queue.SimpleQueue()
+
+def _reset_token_usage(crew):
+    """Zero the per-agent token counters that CrewAI sums into a kickoff's token_usage."""
+    # CrewAI never resets these between kickoffs, so a reused crew would
+    # report usage accumulated over every request it has served
+    for agent in crew.agents:
+        agent._token_process = type(agent._token_process)()
+
+@contextmanager
+def pooled_crew():
+    """Check a warm Restructure crew out of the pool, building one if none is free."""
+    try:
+        crew = _CREW_POOL.get_nowait()
+        _reset_token_usage(crew)
+    except queue.Empty:
+        # Imported on first use so health checks and cold starts don't load CrewAI
+        from restructurer_math.crew import Restructure
+        crew = Restructure().crew()
+    
+    yield crew
+    # Only crews whose kickoff completed go back into the pool
+    _CREW_POOL.put(crew)
+
+# ---
+# ### ⚡ Function to Fetch All Restructure Inputs Concurrently
+# ---
+def fetch_restructure_inputs(subject_id: str, script_id: str):
+    """Fetch OCR, VLMDesc/MCQ and rubrics data concurrently.
+
+    The Django API calls are independent, so they are issued in parallel
+    and the total latency is that of the slowest call. Under the gevent
+    server the pool's threads are greenlets, so concurrent requests on one
+    worker do not contend for an event loop.
+    Each result keeps the (data..., error) tuple shape of its getter.
+    """
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        answersheet_future = pool.submit(get_answersheet_from_ocr, script_id)
+        compare_text_future = pool.submit(get_compare_text_data, script_id)
+        rubrics_future = pool.submit(get_rubrics_from_keyocr, subject_id)
+    return answersheet_future.result(), compare_text_future.result(), rubrics_future.result()
 
 # ---
 # ### 🧠 Updated Core Restructure Logic
 # ---
-def run_restructure(subject_id: str, script_id: str):
-    """Run restructure pipeline using subject_id and script_id."""
+def run_restructure(subject_id: str, script_id: str, use_cache: bool = True):
+    """Run restructure pipeline using subject_id and script_id.
+
+    With use_cache=False any cached crew result is ignored and replaced by
+    the fresh one.
+    """
     try:
+        # Fetch OCR, VLMDesc, MCQ and rubrics concurrently
+        answersheet_res, compare_text_res, rubrics_res = fetch_restructure_inputs(subject_id, script_id)
+
         # Get answer sheet data from OCR endpoint
-        answersheet_text, structured_data, ocr_error = get_answersheet_from_ocr(script_id)
+        answersheet_text, structured_data, ocr_error = answersheet_res
         if ocr_error:
             return False, ocr_error, None
 
         if not answersheet_text:
             return False, f"No answer sheet data found for script_id: {script_id}", None
         
-        # Get VLM description data
-        vlmdesc_data, vlmdesc_error = get_vlmdesc_data(script_id)
-        if vlmdesc_error:
-            logger.warning(f"VLMDesc retrieval error (will use fallback): {vlmdesc_error}")
+        # Get VLM description and MCQ data
+        vlmdesc_data, mcq_data, compare_text_error = compare_text_res
+        if compare_text_error:
+            logger.warning(f"VLMDesc/MCQ retrieval error (will use fallback): {compare_text_error}")
             vlmdesc_data = {}
-        
-        # Get MCQ data
-        mcq_data, mcq_error = get_mcq_data(script_id)
-        if mcq_error:
-            logger.warning(f"MCQ retrieval error (will use fallback): {mcq_error}")
             mcq_data = {}
         
         # Get rubrics
-        rubrics, rubrics_error = get_rubrics_from_keyocr(subject_id)
+        rubrics, rubrics_error = rubrics_res
         if rubrics_error:
             return False, rubrics_error, None
 
@@ -500,66 +722,49 @@ def run_restructure(subject_id: str, script_id: str):
         logger.info(f"VLMDesc: {str(vlmdesc_data)[:100]}...")
         logger.info(f"MCQ: {str(mcq_data)[:100]}...")
 
-        # Print extracted data
-        print("\n" + "="*80)
-        print("📄 EXTRACTED ANSWER SHEET FROM OCR:")
-        print("="*80)
-        print(answersheet_text)
-        print("\n" + "="*80)
-        print("📊 STRUCTURED OCR DATA:")
-        print("="*80)
-        print(json.dumps(structured_data, indent=2) if structured_data else "No structured data")
-        print("\n" + "="*80)
-        print("📝 RUBRICS:")
-        print("="*80)
-        print(rubrics)
-        print("\n" + "="*80)
-        print("🔍 VLMDESC:")
-        print("="*80)
-        print(vlmdesc_data)
-        print("\n" + "="*80)
-        print("📊 MCQ:")
-        print("="*80)
-        print(mcq_data)
-        print("="*80 + "\n")
-
-        # Run the agent
-        result = Restructure().crew().kickoff(inputs=inputs)
-        print(f"\nToken Usage:\n{result.token_usage}\n")
-        
-        # Convert result to string
-        result_text = str(result)
+        # Dump extracted data only when debug logging is enabled
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Extracted answer sheet from OCR:\n%s", answersheet_text)
+            logger.debug(
+                "Structured OCR data:\n%s",
+                orjson.dumps(structured_data).decode() if structured_data else "No structured data",
+            )
+            logger.debug("Rubrics:\n%s", rubrics)
+            logger.debug("VLMDesc:\n%s", vlmdesc_data)
+            logger.debug("MCQ:\n%s", mcq_data)
+
+        # Reuse a cached crew result for identical inputs; hashing the inputs
+        # is skipped entirely while the cache is disabled
+        cache_key = cache.make_key(inputs) if cache.LLM_CACHE_ENABLED else None
+        result_text = cache.get(cache_key) if cache_key and use_cache else None
+        
+        if result_text is not None:
+            logger.info(f"LLM cache hit for script_id: {script_id}")
+        else:
+            # Run the agent
+            with pooled_crew() as crew:
+                result = crew.kickoff(inputs=inputs)
+            logger.info("Token usage: %s", result.token_usage)
+            
+            # Convert result to string
+            result_text = str(result)
+            if cache_key:
+                cache.set(cache_key, result_text)
         
         # Format result as Q&A pairs
         formatted_result = format_as_qa_pairs(result_text)
         
-        # Print formatted Q&A pairs
-        print("\n" + "="*80)
-        print("🎯 FORMATTED QUESTION-ANSWER PAIRS:")
-        print("="*80)
-        print(formatted_result["formatted_display"])
-        print("="*80 + "\n")
+        logger.debug("Formatted question-answer pairs:\n%s", formatted_result["formatted_display"])
 
         # Save to database
-        save_success, save_result, save_error = save_result_to_database(script_id, formatted_result)
+        db_success, database_operation, db_result, db_error = upsert_result(script_id, formatted_result)
         
-        if not save_success:
-            # If save failed, try to update existing record
-            logger.warning(f"Save failed, trying to update existing record: {save_error}")
-            update_success, update_result, update_error = update_result_in_database(script_id, formatted_result)
-            
-            if update_success:
-                logger.info(f"Successfully updated existing result for script_id: {script_id}")
-                database_operation = "updated"
-                database_result = update_result
-            else:
-                logger.error(f"Both save and update failed for script_id: {script_id}")
-                database_operation = "failed"
-                database_result = {"error": update_error}
+        if db_success:
+            logger.info(f"Successfully {database_operation} result for script_id: {script_id}")
+            database_result = db_result
         else:
-            logger.info(f"Successfully saved new result for script_id: {script_id}")
-            database_operation = "created"
-            database_result = save_result
+            logger.error(f"Database save failed for script_id: {script_id}: {db_error}")
+            database_result = {"error": db_error}
 
         logger.info(f"Restructure completed successfully for script_id: {script_id}")
         
@@ -573,106 +778,252 @@ def run_restructure(subject_id: str, script_id: str):
         logger.error(f"Restructure failed: {str(e)}")
         return False, f"Error: {str(e)}", None
 
+# ---
+# ### 🧵 Background Restructure Jobs
+# ---
+RESTRUCTURE_WORKERS = int(os.environ.get('RESTRUCTURE_WORKERS', 4))
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+def get_executor():
+    """Return the process pool for background restructure jobs, creating it on first use."""
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ProcessPoolExecutor(
+                max_workers=RESTRUCTURE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _EXECUTOR
+
+def _discard_executor(broken):
+    """Drop a broken process pool so the next get_executor() builds a fresh one."""
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        # Another request may already have replaced it
+        if _EXECUTOR is broken:
+            _EXECUTOR = None
+    broken.shutdown(wait=False)
+
+def _record_job_result(job_id: str, future):
+    """Store the outcome of a finished restructure future in the job store."""
+    try:
+        success, message, formatted_result = future.result()
+    except Exception as e:
+        logger.error(f"Restructure job {job_id} failed: {str(e)}")
+        success, message, formatted_result = False, f"Error: {str(e)}", None
+    jobs.finish(job_id, success, message, formatted_result)
+
+def submit_restructure_job(subject_id: str, script_id: str, use_cache: bool = True):
+    """Queue run_restructure in the process pool and return its job_id."""
+    job_id = uuid.uuid4().hex
+    jobs.create(job_id, subject_id, script_id)
+    try:
+        try:
+            executor = get_executor()
+            future = executor.submit(run_restructure, subject_id, script_id, use_cache)
+        except BrokenProcessPool:
+            # A pool process died (e.g. OOM-killed mid-kickoff), which breaks
+            # the whole pool; replace it and try once more
+            logger.warning("Restructure process pool is broken, starting a new one")
+            _discard_executor(executor)
+            future = get_executor().submit(run_restructure, subject_id, script_id, use_cache)
+    except Exception as e:
+        jobs.finish(job_id, False, f"Error: failed to queue restructure: {str(e)}", None)
+        raise
+    future.add_done_callback(partial(_record_job_result, job_id))
+    return job_id
+
 # ---
 # ### 🚀 Flask Application
 # ---
-def run():
-    """Start the Flask application for restructure."""
-    app = Flask(__name__)
-    app.secret_key = 'restructure_secret_key'
-    
-    # CORS configuration
-    cors_config = {
-        "origins": [
-            "http://localhost:3000",
-            "https://transgrade.transpoze.ai",
-            "http://localhost:3001",
-            "https://transpoze.ai",
-            "https://*.transpoze.ai",
-            "http://127.0.0.1:3000",
-            "http://localhost:8000",
-            "https://localhost:3000"
-        ],
-        "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"],
-        "allow_headers": ['*'],
-        "supports_credentials": True
-    }
-    
-    CORS(app, **cors_config)
-    
-    @app.route('/mathres/')
-    def index():
-        """Root endpoint with API information."""
+app = Flask(__name__)
+app.secret_key = 'restructure_secret_key'
+
+# CORS configuration
+cors_config = {
+    "origins": [
+        "http://localhost:3000",
+        "https://transgrade.transpoze.ai",
+        "http://localhost:3001",
+        "https://transpoze.ai",
+        "https://*.transpoze.ai",
+        "http://127.0.0.1:3000",
+        "http://localhost:8000",
+        "https://localhost:3000"
+    ],
+    "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"],
+    "allow_headers": ['*'],
+    "supports_credentials": True
+}
+
+CORS(app, **cors_config)
+
+@app.route('/mathres/')
+def index():
+    """Root endpoint with API information."""
+    return jsonify({
+        "message": "Restructure API is running",
+        "endpoints": {
+            "restructure": "/restructure/restructure/<subject_id>/<script_id>",
+            "restructure_result": "/mathres/restructure/result/<job_id>",
+            "health_check": "/restructure/health",
+            "invalidate_rubrics_cache": "/mathres/cache/invalidate/<subject_id>"
+        }
+    })
+
+@app.route('/mathres/restructure/<subject_id>/<script_id>', methods=['GET', 'POST'])
+def restructure_route(subject_id, script_id):
+    """Endpoint to run restructure for a given subject_id and script_id.
+
+    GET (or POST with ?sync=1) runs the restructure and returns its result.
+    POST queues a background job and returns its job_id immediately.
+    ?nocache=1 skips the LLM result cache and runs the crew again.
+    """
+    if not subject_id or not script_id:
         return jsonify({
-            "message": "Restructure API is running",
-            "endpoints": {
-                "restructure": "/restructure/restructure/<subject_id>/<script_id>",
-                "health_check": "/restructure/health"
-            }
-        })
+            "status": "error", 
+            "message": "Subject ID and Script ID are required"
+        }), 400
 
-    @app.route('/mathres/restructure/<subject_id>/<script_id>', methods=['GET'])
-    def restructure_route(subject_id, script_id):
-        """Endpoint to run restructure for a given subject_id and script_id."""
-        if not subject_id or not script_id:
+    use_cache = request.args.get('nocache') != '1'
+
+    if request.method == 'POST' and request.args.get('sync') != '1':
+        try:
+            job_id = submit_restructure_job(subject_id, script_id, use_cache)
+        except Exception as e:
+            logger.error(f"Failed to queue restructure for script_id: {script_id}: {str(e)}")
             return jsonify({
-                "status": "error", 
-                "message": "Subject ID and Script ID are required"
-            }), 400
-        
-        logger.info(f"Processing restructure for subject_id: {subject_id}, script_id: {script_id}")
-        success, message, formatted_result = run_restructure(subject_id, script_id)
-        
-        response_data = {
-            "status": "success" if success else "error",
+                "status": "error",
+                "subject_id": str(subject_id),
+                "script_id": str(script_id),
+                "message": f"Failed to queue restructure: {str(e)}"
+            }), 503
+        logger.info(f"Queued restructure job {job_id} for subject_id: {subject_id}, script_id: {script_id}")
+        return jsonify({
+            "status": jobs.PENDING,
+            "job_id": job_id,
             "subject_id": str(subject_id),
             "script_id": str(script_id),
-            "message": message
-        }
-        
-        if success and formatted_result:
-            response_data["result"] = formatted_result
-        
-        return jsonify(response_data), 200 if success else 500
+            "result_url": f"/mathres/restructure/result/{job_id}"
+        }), 202
 
-    @app.route('/mathres/health')
-    def health_check():
-        """Health check endpoint to verify Django API connectivity."""
-        try:
-            response = requests.get(f"{DJANGO_API_BASE_URL}/", timeout=5)
-            if response.status_code == 200:
-                return jsonify({
-                    "status": "healthy", 
-                    "django_api": "connected",
-                    "django_url": DJANGO_API_BASE_URL
-                })
-            else:
-                return jsonify({
-                    "status": "unhealthy", 
-                    "django_api": "error", 
-                    "details": f"Status: {response.status_code}"
-                })
-        except Exception as e:
+    logger.info(f"Processing restructure for subject_id: {subject_id}, script_id: {script_id}")
+    success, message, formatted_result = run_restructure(subject_id, script_id, use_cache)
+
+    response_data = {
+        "status": "success" if success else "error",
+        "subject_id": str(subject_id),
+        "script_id": str(script_id),
+        "message": message
+    }
+
+    if success and formatted_result:
+        response_data["result"] = formatted_result
+
+    return jsonify(response_data), 200 if success else 500
+
+@app.route('/mathres/restructure/result/<job_id>', methods=['GET'])
+def restructure_result_route(job_id):
+    """Endpoint to poll the status and result of a background restructure job."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({
+            "status": "error",
+            "job_id": job_id,
+            "message": f"Unknown job_id: {job_id}"
+        }), 404
+
+    response_data = {
+        "status": job["status"],
+        "job_id": job_id,
+        "subject_id": job["subject_id"],
+        "script_id": job["script_id"],
+        "message": job["message"]
+    }
+
+    if job["status"] == jobs.SUCCESS and job["result"]:
+        response_data["result"] = job["result"]
+
+    return jsonify(response_data), 500 if job["status"] == jobs.ERROR else 200
+
+@app.route('/mathres/health')
+def health_check():
+    """Health check endpoint to verify Django API connectivity."""
+    try:
+        response = _request('GET', f"{DJANGO_API_BASE_URL}/", timeout=5)
+        if response.status_code == 200:
+            return jsonify({
+                "status": "healthy", 
+                "django_api": "connected",
+                "django_url": DJANGO_API_BASE_URL
+            })
+        else:
             return jsonify({
                 "status": "unhealthy", 
-                "django_api": "disconnected", 
-                "error": str(e)
+                "django_api": "error", 
+                "details": f"Status: {response.status_code}"
             })
+    except Exception as e:
+        return jsonify({
+            "status": "unhealthy", 
+            "django_api": "disconnected", 
+            "error": str(e)
+        })
 
-   
-    
-    # Handle OPTIONS requests for CORS preflight
-    @app.before_request
-    def handle_preflight():        
-        if request.method == "OPTIONS":
-            response = jsonify({})
-            response.headers.add("Access-Control-Allow-Origin", "*")
-            response.headers.add('Access-Control-Allow-Headers', "*")
-            response.headers.add('Access-Control-Allow-Methods', "*")
-            return response
+@app.route('/mathres/cache/invalidate/<subject_id>', methods=['POST'])
+def invalidate_cache_route(subject_id):
+    """Endpoint to drop cached rubrics for a subject after they are edited."""
+    try:
+        invalidate_rubrics_cache(subject_id)
+    except sqlite3.Error as e:
+        logger.error(f"Failed to invalidate rubrics cache for subject_id: {subject_id}: {str(e)}")
+        return jsonify({
+            "status": "error",
+            "subject_id": str(subject_id),
+            "message": f"Failed to invalidate rubrics cache: {str(e)}"
+        }), 503
+    logger.info(f"Rubrics cache invalidated for subject_id: {subject_id}")
+    return jsonify({
+        "status": "success",
+        "subject_id": str(subject_id),
+        "invalidated": True
+    })
 
-    # Run Flask app
+# Handle OPTIONS requests for CORS preflight
+@app.before_request
+def handle_preflight():        
+    if request.method == "OPTIONS":
+        response = jsonify({})
+        response.headers.add("Access-Control-Allow-Origin", "*")
+        response.headers.add('Access-Control-Allow-Headers', "*")
+        response.headers.add('Access-Control-Allow-Methods', "*")
+        return response
+
+# ---
+# ### ▶️ Server Entry Point
+# ---
+def run():
+    """Start the Flask application for restructure.
+
+    With PROD=1 the app is served by gunicorn with gevent workers so slow
+    restructure requests do not block each other; otherwise the Flask
+    development server is used.
+    """
     port = int(os.environ.get('PORT', 8888))
+    
+    if os.environ.get('PROD') == '1':
+        workers = os.environ.get('WEB_CONCURRENCY', '4')
+        os.execvp('gunicorn', [
+            'gunicorn',
+            '-k', 'gevent',
+            '-w', workers,
+            '--worker-connections', '1000',
+            '-b', f'0.0.0.0:{port}',
+            'restructurer_math.main:app',
+        ])
+    
+    # Run Flask app
     app.run(host='0.0.0.0', port=port, debug=False)
 
 # ---
@@ -680,6 +1031,8 @@ def run():
 # ---
 
 if __name__ == "__main__":
+    import sys
+    
     if len(sys.argv) > 1 and sys.argv[1].lower() == "run":
         run()
     else:
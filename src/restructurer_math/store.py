@@ -0,0 +1,8 @@
+import sqlite3
+
+
+def connect(path: str, schema: str):
+    """Open a connection to the SQLite database at path, running schema to create its table if needed."""
+    conn = sqlite3.connect(path, timeout=10)
+    conn.execute(schema)
+    return conn
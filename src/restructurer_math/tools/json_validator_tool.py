@@ -1,8 +1,183 @@
 from crewai.tools import BaseTool
 from typing import Type, List, Dict, Any
 from pydantic import BaseModel, Field
-import json
 import re
+import logging
+import orjson
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Markdown code fences, with or without a json language tag
+_JSON_FENCE_RE = re.compile(r'```(?:json)?\s*')
+_NUM_RE = re.compile(r'\d+')
+_JSON_START_RE = re.compile(r'[\[{]')
+
+# Characters trimmed from both ends of a plain-text "key: value" value
+_VALUE_STRIP_CHARS = ' \t\r"\','
+
+# Line prefixes and keywords recognised by the plain-text fallbacks (lowercase)
+_QUESTION_PREFIXES = ('"question"', 'question')
+_ANSWER_PREFIXES = ('"answer"', 'answer')
+_MARK_KEYS = ('marks_awarded', 'marks', 'score', 'points')
+
+
+def _loads(s):
+    """Parse JSON text with orjson."""
+    return orjson.loads(s)
+
+
+def _dumps(obj) -> str:
+    """Serialise obj as indented, non-ASCII-preserving JSON text."""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+
+
+# Formatters are module-level functions so identical agent outputs (retries,
+# re-renders) can be served from an LRU cache keyed on the output. They raise
+# orjson.JSONDecodeError for output that is not JSON, which is not cached.
+@lru_cache(maxsize=256)
+def _format_restructure_cached(output: str) -> str:
+    """Format JSON output for restructure task."""
+    data = _loads(output)
+
+    # Ensure data is a list
+    if not isinstance(data, list):
+        data = [data]
+
+    # Validate and ensure correct structure; non-object entries have no
+    # .get and are skipped
+    formatted_data = []
+    for item in data:
+        try:
+            question = item.get("question", "")
+            answer = item.get("answer", "")
+            diagram = item.get("diagram_or_equation", "")
+        except AttributeError:
+            continue
+        formatted_data.append({
+            "question": str(question),
+            "answer": str(answer),
+            "diagram_or_equation": str(diagram)
+        })
+
+    return _dumps(formatted_data)
+
+
+def _coerce_marks(item: dict) -> int:
+    """Return the first integer-convertible marks value under any known key, else 0."""
+    # Handle different possible key names for marks
+    for key in _MARK_KEYS:
+        value = item.get(key)
+        if value is not None:
+            try:
+                return int(value)
+            except (ValueError, TypeError):
+                continue
+    return 0
+
+
+@lru_cache(maxsize=256)
+def _format_marking_cached(output: str) -> str:
+    """Format JSON output for marking task."""
+    data = _loads(output)
+
+    # Ensure data is a list
+    if not isinstance(data, list):
+        data = [data]
+
+    # Validate and ensure correct structure; non-object entries have no
+    # .get and are skipped
+    formatted_data = []
+    for item in data:
+        try:
+            question = item.get("question", "")
+            marks_value = _coerce_marks(item)
+        except AttributeError:
+            continue
+        formatted_data.append({
+            "question": str(question),
+            "marks_awarded": marks_value
+        })
+
+    return _dumps(formatted_data)
+
+
+def _extract_restructure_from_text(text: str) -> str:
+    """Extract restructure format from plain text when JSON parsing fails."""
+    # This is a fallback method to extract question-answer pairs from text
+    lines = text.split('\n')
+    result = []
+    question, answer, diagram = "", "", ""
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        lowered = line.lower()
+
+        if lowered.startswith(_QUESTION_PREFIXES):
+            if question:
+                result.append({"question": question, "answer": answer, "diagram_or_equation": diagram})
+                answer, diagram = "", ""
+            question = _extract_value(line)
+        elif lowered.startswith(_ANSWER_PREFIXES):
+            answer = _extract_value(line)
+        elif 'diagram' in lowered:
+            diagram = _extract_value(line)
+
+    if question:
+        result.append({"question": question, "answer": answer, "diagram_or_equation": diagram})
+
+    return _dumps(result)
+
+
+def _extract_marking_from_text(text: str) -> str:
+    """Extract marking format from plain text when JSON parsing fails."""
+    lines = text.split('\n')
+    result = []
+    question, marks = "", 0
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        lowered = line.lower()
+
+        if lowered.startswith(_QUESTION_PREFIXES):
+            if question:
+                result.append({"question": question, "marks_awarded": marks})
+                marks = 0
+            question = _extract_value(line)
+        elif any(keyword in lowered for keyword in _MARK_KEYS):
+            try:
+                marks = int(_extract_numeric_value(line))
+            except ValueError:
+                marks = 0
+
+    if question:
+        result.append({"question": question, "marks_awarded": marks})
+
+    return _dumps(result)
+
+
+def _extract_value(line: str) -> str:
+    """Extract value from a key-value line."""
+    _, sep, value = line.partition(':')
+    # Strip whitespace, quotes and trailing commas in a single pass
+    return (value if sep else line).strip(_VALUE_STRIP_CHARS)
+
+
+def _extract_numeric_value(line: str) -> str:
+    """Extract numeric value from a line."""
+    match = _NUM_RE.search(line)
+    return match.group() if match else "0"
+
+
+# output_type -> (JSON formatter, plain-text fallback)
+_FORMATTERS = {
+    'restructure': (_format_restructure_cached, _extract_restructure_from_text),
+    'marking': (_format_marking_cached, _extract_marking_from_text),
+}
 
 
 class JSONStructureInput(BaseModel):
@@ -32,180 +207,52 @@ class JSONStructureValidatorTool(BaseTool):
             Valid JSON string in the expected format
         """
         try:
-            # Clean the raw output
-            cleaned_output = self._clean_raw_output(raw_output)
+            try:
+                format_json, format_text = _FORMATTERS[output_type.lower()]
+            except KeyError:
+                raise ValueError(f"Unknown output_type: {output_type}") from None
             
-            if output_type.lower() == 'restructure':
-                return self._format_restructure_output(cleaned_output)
-            elif output_type.lower() == 'marking':
-                return self._format_marking_output(cleaned_output)
-            else:
-                raise ValueError(f"Unknown output_type: {output_type}")
+            # Well-formed JSON (the common case) is formatted without cleaning
+            try:
+                return format_json(raw_output)
+            except orjson.JSONDecodeError:
+                pass
+            
+            cleaned_output = self._clean_raw_output(raw_output)
+            try:
+                return format_json(cleaned_output)
+            except orjson.JSONDecodeError as e:
+                logger.debug("JSON parsing failed: %s", e)
+                # If JSON parsing fails, try to extract structure from text
+                return format_text(cleaned_output)
                 
         except Exception as e:
             # Fallback: return empty structure if parsing fails
             if output_type.lower() == 'restructure':
-                return json.dumps([{
+                return _dumps([{
                     "question": "Error in processing",
                     "answer": f"Processing error: {str(e)}",
                     "diagram_or_equation": ""
-                }], indent=2)
+                }])
             else:
-                return json.dumps([{
+                return _dumps([{
                     "question": "Error in processing",
                     "marks_awarded": 0
-                }], indent=2)
+                }])
 
     def _clean_raw_output(self, raw_output: str) -> str:
         """Clean and extract JSON from raw output."""
         # Remove markdown code blocks
-        cleaned = re.sub(r'```json\s*', '', raw_output)
-        cleaned = re.sub(r'```\s*', '', cleaned)
-        
-        # Remove any text before the first [ or {
-        json_start = max(cleaned.find('['), cleaned.find('{'))
-        if json_start != -1:
-            cleaned = cleaned[json_start:]
-        
-        # Remove any text after the last ] or }
-        json_end_bracket = cleaned.rfind(']')
-        json_end_brace = cleaned.rfind('}')
-        json_end = max(json_end_bracket, json_end_brace)
-        if json_end != -1:
-            cleaned = cleaned[:json_end + 1]
-        
-        return cleaned.strip()
-
-    def _format_restructure_output(self, cleaned_output: str) -> str:
-        """Format output for restructure task."""
-        try:
-            # Try to parse as JSON first
-            data = json.loads(cleaned_output)
-            
-            # Ensure data is a list
-            if not isinstance(data, list):
-                data = [data]
-            
-            # Validate and ensure correct structure
-            formatted_data = []
-            for item in data:
-                if not isinstance(item, dict):
-                    continue
-                    
-                formatted_item = {
-                    "question": str(item.get("question", "")),
-                    "answer": str(item.get("answer", "")),
-                    "diagram_or_equation": str(item.get("diagram_or_equation", ""))
-                }
-                formatted_data.append(formatted_item)
-            
-            return json.dumps(formatted_data, indent=2, ensure_ascii=False)
-            
-        except json.JSONDecodeError:
-            # If JSON parsing fails, try to extract structure from text
-            return self._extract_restructure_from_text(cleaned_output)
-
-    def _format_marking_output(self, cleaned_output: str) -> str:
-        """Format output for marking task."""
-        try:
-            # Try to parse as JSON first
-            data = json.loads(cleaned_output)
-            
-            # Ensure data is a list
-            if not isinstance(data, list):
-                data = [data]
-            
-            # Validate and ensure correct structure
-            formatted_data = []
-            for item in data:
-                if not isinstance(item, dict):
-                    continue
-                
-                # Handle different possible key names for marks
-                marks_value = 0
-                for key in ['marks_awarded', 'marks', 'score', 'points']:
-                    if key in item:
-                        try:
-                            marks_value = int(item[key])
-                            break
-                        except (ValueError, TypeError):
-                            marks_value = 0
-                
-                formatted_item = {
-                    "question": str(item.get("question", "")),
-                    "marks_awarded": marks_value
-                }
-                formatted_data.append(formatted_item)
-            
-            return json.dumps(formatted_data, indent=2, ensure_ascii=False)
-            
-        except (json.JSONDecodeError, ValueError) as e:
-            print(f"JSON parsing failed: {e}")  # Debug print
-            # If JSON parsing fails, try to extract structure from text
-            return self._extract_marking_from_text(cleaned_output)
-
-    def _extract_restructure_from_text(self, text: str) -> str:
-        """Extract restructure format from plain text when JSON parsing fails."""
-        # This is a fallback method to extract question-answer pairs from text
-        lines = text.split('\n')
-        result = []
-        current_item = {"question": "", "answer": "", "diagram_or_equation": ""}
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            if line.startswith('"question"') or line.lower().startswith('question'):
-                if current_item["question"]:
-                    result.append(current_item.copy())
-                    current_item = {"question": "", "answer": "", "diagram_or_equation": ""}
-                current_item["question"] = self._extract_value(line)
-            elif line.startswith('"answer"') or line.lower().startswith('answer'):
-                current_item["answer"] = self._extract_value(line)
-            elif line.startswith('"diagram_or_equation"') or 'diagram' in line.lower():
-                current_item["diagram_or_equation"] = self._extract_value(line)
-        
-        if current_item["question"]:
-            result.append(current_item)
-        
-        return json.dumps(result, indent=2, ensure_ascii=False)
-
-    def _extract_marking_from_text(self, text: str) -> str:
-        """Extract marking format from plain text when JSON parsing fails."""
-        lines = text.split('\n')
-        result = []
-        current_item = {"question": "", "marks_awarded": 0}
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            if line.startswith('"question"') or line.lower().startswith('question'):
-                if current_item["question"]:
-                    result.append(current_item.copy())
-                    current_item = {"question": "", "marks_awarded": 0}
-                current_item["question"] = self._extract_value(line)
-            elif any(keyword in line.lower() for keyword in ['marks_awarded', 'marks', 'score', 'points']):
-                try:
-                    current_item["marks_awarded"] = int(self._extract_numeric_value(line))
-                except ValueError:
-                    current_item["marks_awarded"] = 0
+        cleaned = _JSON_FENCE_RE.sub('', raw_output)
         
-        if current_item["question"]:
-            result.append(current_item)
+        # Keep only the text from the first [ or { to the last ] or } after it
+        match = _JSON_START_RE.search(cleaned)
+        start = match.start() if match else 0
+        end = max(cleaned.rfind(']', start), cleaned.rfind('}', start))
         
-        return json.dumps(result, indent=2, ensure_ascii=False)
-
-    def _extract_value(self, line: str) -> str:
-        """Extract value from a key-value line."""
-        if ':' in line:
-            return line.split(':', 1)[1].strip().strip('"').strip("'").rstrip(',')
-        return line.strip().strip('"').strip("'").rstrip(',')
-
-    def _extract_numeric_value(self, line: str) -> str:
-        """Extract numeric value from a line."""
-        import re
-        numbers = re.findall(r'\d+', line)
-        return numbers[0] if numbers else "0"
\ No newline at end of file
+        if match and end != -1:
+            # Both ends are structural characters, so there is nothing to strip
+            return cleaned[start:end + 1]
+        if end != -1:
+            return cleaned[:end + 1].strip()
+        return cleaned[start:].strip()
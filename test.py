@@ -3,11 +3,110 @@
 Fixed QA extractor that handles all possible data formats
 """
 
-import requests
+import asyncio
+import argparse
 import json
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+import orjson
 import re
 from typing import List, Dict, Any
 
+logger = logging.getLogger(__name__)
+
+_JSON_BLOCK_RE = re.compile(r'```json\s*\n(.*?)\n\s*```', re.DOTALL)
+_ARRAY_RE = re.compile(r'\[\s*\{.*?\}\s*\]', re.DOTALL)
+_WHITESPACE_RE = re.compile(r'\s*')
+# Where a JSON object can start: "{" followed by a key or the closing brace
+_OBJECT_START_RE = re.compile(r'\{\s*["}]')
+# Tokens that matter for brace matching: escape pairs, quotes and braces
+_STRUCTURAL_RE = re.compile(r'\\.|["{}]', re.DOTALL)
+
+# Connections kept per host, and the most fetches extract_qa_pairs_many runs at once
+_POOL_SIZE = 32
+
+# Shared decoder for raw_decode, which orjson has no equivalent of
+_DECODER = json.JSONDecoder()
+
+def _loads(s):
+    """Parse JSON text with orjson."""
+    return orjson.loads(s)
+
+def _dumps(obj) -> str:
+    """Serialise obj as indented, non-ASCII-preserving JSON text."""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+
+def _json_documents(text: str) -> List[Any]:
+    """
+    Parse text as a sequence of JSON documents separated only by whitespace,
+    raising json.JSONDecodeError if anything else is in between (or
+    RecursionError if a document nests too deeply)
+    """
+    documents = []
+    idx = _WHITESPACE_RE.match(text).end()
+    while idx < len(text):
+        data, idx = _DECODER.raw_decode(text, idx)
+        documents.append(data)
+        idx = _WHITESPACE_RE.match(text, idx).end()
+    return documents
+
+def _brace_ends(text: str, start: int, ends: Dict[int, Any]) -> None:
+    """
+    Scan from the "{" at start to its matching "}", treating start as outside
+    any string. Records in ends the end offset of every brace opened outside
+    a string along the way, or None for those still open at the end of text
+    """
+    openers = []
+    in_string = False
+    for match in _STRUCTURAL_RE.finditer(text, start):
+        token = match.group()
+        if in_string:
+            # Escape pairs are consumed whole, so only a bare quote closes
+            if token == '"':
+                in_string = False
+            continue
+        # Outside strings a backslash is an ordinary character
+        token = token[-1]
+        if token == '"':
+            in_string = True
+        elif token == '{':
+            openers.append(match.end() - 1)
+        elif token == '}':
+            ends[openers.pop()] = match.end()
+            if not openers:
+                return
+    for opener in openers:
+        ends[opener] = None
+
+def _json_objects(text: str) -> List[Dict]:
+    """
+    Parse the JSON objects embedded in text. Each place an object can start
+    gets its own brace scan, so a stray quote in one malformed object cannot
+    hide the objects after it; a scan also resolves every brace it passes,
+    so later candidates rarely rescan. Only closed spans are decoded, and a
+    valid object is taken whole
+    """
+    objects = []
+    ends = {}
+    resume = 0
+    for match in _OBJECT_START_RE.finditer(text):
+        start = match.start()
+        if start < resume:
+            # Nested inside an object that already parsed
+            continue
+        if start not in ends:
+            _brace_ends(text, start, ends)
+        end = ends[start]
+        if end is None:
+            continue
+        try:
+            objects.append(_loads(text[start:end]))
+        except orjson.JSONDecodeError:
+            continue
+        resume = end
+    return objects
+
 class FixedQAExtractor:
     """
     A robust QA extractor that handles various data formats
@@ -15,15 +114,21 @@ class FixedQAExtractor:
     
     def __init__(self, base_url="https://transback.transpoze.ai"):
         self.base_url = base_url.rstrip('/')
+        # Reuse pooled keep-alive connections across fetches
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=_POOL_SIZE, max_retries=3)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
     
     def fetch_result(self, result_id: int) -> Dict[str, Any]:
         """Fetch result data from API"""
         try:
-            response = requests.get(f"{self.base_url}/results/?result_id={result_id}")
+            response = self._session.get(f"{self.base_url}/results/?result_id={result_id}", timeout=10)
             response.raise_for_status()
-            return response.json()
+            # Parse the raw body bytes directly, skipping requests' decode-then-json.loads
+            return _loads(response.content)
         except Exception as e:
-            print(f"Error fetching result {result_id}: {e}")
+            logger.error("Error fetching result %s: %s", result_id, e)
             return {}
     
     def extract_json_from_text(self, text: str) -> List[Dict]:
@@ -33,54 +138,61 @@ class FixedQAExtractor:
         if not isinstance(text, str):
             return []
         
-        # Method 1: Direct JSON parsing
-        try:
-            data = json.loads(text.strip())
-            if isinstance(data, list):
-                return data
-            elif isinstance(data, dict):
-                return [data]
-        except json.JSONDecodeError:
-            pass
+        # Method 1: Direct JSON parsing, only attempted when the text can be a
+        # JSON array or object (plain-text answers skip the failing parse)
+        stripped = text.strip()
+        if stripped[:1] in ('[', '{'):
+            try:
+                data = _loads(stripped)
+                if isinstance(data, list):
+                    return data
+                elif isinstance(data, dict):
+                    return [data]
+            except orjson.JSONDecodeError:
+                pass
+            
+            # Method 2: Concatenated JSON documents (NDJSON or back-to-back
+            # objects/arrays), walked in one pass with raw_decode
+            objects = []
+            try:
+                for data in _json_documents(stripped):
+                    if isinstance(data, list):
+                        objects.extend(data)
+                    elif isinstance(data, dict):
+                        objects.append(data)
+            except (json.JSONDecodeError, RecursionError):
+                # Too deeply nested for the stdlib decoder, or not documents at all
+                objects = []
+            
+            if objects:
+                return objects
         
-        # Method 2: Extract from markdown code blocks
-        json_pattern = r'```json\s*\n(.*?)\n\s*```'
-        matches = re.findall(json_pattern, text, re.DOTALL)
+        # Method 3: Extract from markdown code blocks
+        matches = _JSON_BLOCK_RE.findall(text)
         
         for match in matches:
             try:
-                data = json.loads(match.strip())
+                data = _loads(match.strip())
                 if isinstance(data, list):
                     return data
                 elif isinstance(data, dict):
                     return [data]
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 continue
         
-        # Method 3: Look for JSON arrays in the text
-        array_pattern = r'\[\s*\{.*?\}\s*\]'
-        array_matches = re.findall(array_pattern, text, re.DOTALL)
+        # Method 4: Look for JSON arrays in the text
+        array_matches = _ARRAY_RE.findall(text)
         
         for match in array_matches:
             try:
-                data = json.loads(match)
+                data = _loads(match)
                 if isinstance(data, list):
                     return data
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 continue
         
-        # Method 4: Look for individual JSON objects
-        object_pattern = r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}'
-        object_matches = re.findall(object_pattern, text)
-        
-        objects = []
-        for match in object_matches:
-            try:
-                obj = json.loads(match)
-                if isinstance(obj, dict):
-                    objects.append(obj)
-            except json.JSONDecodeError:
-                continue
+        # Method 5: Look for individual JSON objects
+        objects = _json_objects(text)
         
         if objects:
             return objects
@@ -91,7 +203,27 @@ class FixedQAExtractor:
         """
         Extract QA pairs from a result
         """
-        result_data = self.fetch_result(result_id)
+        return self._qa_pairs_from_result(self.fetch_result(result_id))
+    
+    async def extract_qa_pairs_many(self, result_ids: List[int]) -> List[List[Dict]]:
+        """
+        Extract QA pairs from several results, in the order of result_ids.
+        Up to _POOL_SIZE fetches run at once on worker threads; each result
+        is parsed as soon as it arrives while the remaining fetches are in flight.
+        """
+        limit = asyncio.Semaphore(_POOL_SIZE)
+        
+        async def fetch_and_parse(result_id):
+            async with limit:
+                result_data = await asyncio.to_thread(self.fetch_result, result_id)
+            return self._qa_pairs_from_result(result_data)
+        
+        return await asyncio.gather(*map(fetch_and_parse, result_ids))
+    
+    def _qa_pairs_from_result(self, result_data: Dict[str, Any]) -> List[Dict]:
+        """
+        Extract QA pairs from fetched result data
+        """
         if not result_data:
             return []
         
@@ -113,51 +245,56 @@ class FixedQAExtractor:
         restructuredtext = result_data.get('restructuredtext', {})
         qa_entries = restructuredtext.get('qa_pairs', [])
         
-        print(f"Found {len(qa_entries)} QA entries in restructuredtext")
+        logger.debug("Found %d QA entries in restructuredtext", len(qa_entries))
         
         for entry_idx, qa_entry in enumerate(qa_entries):
-            print(f"\nProcessing QA entry {entry_idx + 1}...")
+            logger.debug("Processing QA entry %d...", entry_idx + 1)
             
             if not isinstance(qa_entry, dict):
-                print(f"  Skipping non-dict entry")
+                logger.debug("  Skipping non-dict entry")
                 continue
             
             # Check if there's an answer field
             if 'answer' not in qa_entry:
-                print(f"  No 'answer' field found")
+                logger.debug("  No 'answer' field found")
                 continue
             
             answer_content = qa_entry['answer']
-            print(f"  Answer type: {type(answer_content)}")
-            print(f"  Answer preview: {str(answer_content)[:100]}...")
+            logger.debug("  Answer type: %s", type(answer_content))
+            logger.debug("  Answer preview: %.100s...", answer_content)
             
             # Extract JSON data from the answer
             json_data = self.extract_json_from_text(answer_content)
-            print(f"  Extracted {len(json_data)} JSON objects")
+            logger.debug("  Extracted %d JSON objects", len(json_data))
             
             if json_data:
                 # Process each JSON object as a QA pair
                 for idx, item in enumerate(json_data):
-                    if isinstance(item, dict):
-                        qa_pair = {
-                            **metadata,
-                            'entry_index': entry_idx,
-                            'qa_pair_index': idx,
-                            'question': item.get('question', ''),
-                            'answer': item.get('answer', ''),
-                            'diagram_or_equation': item.get('diagram_or_equation', ''),
-                            'original_question': qa_entry.get('question', '')
-                        }
-                        
-                        # Only add if it has a question
-                        if qa_pair['question'].strip():
-                            qa_pairs.append(qa_pair)
-                            print(f"    Added QA pair: {qa_pair['question'][:50]}...")
+                    # Non-object entries have no .get and are skipped
+                    try:
+                        question = item.get('question', '')
+                        answer = item.get('answer', '')
+                        diagram = item.get('diagram_or_equation', '')
+                    except AttributeError:
+                        continue
+                    
+                    qa_pair = metadata | {
+                        'entry_index': entry_idx,
+                        'qa_pair_index': idx,
+                        'question': question,
+                        'answer': answer,
+                        'diagram_or_equation': diagram,
+                        'original_question': qa_entry.get('question', '')
+                    }
+                    
+                    # Only add if it has a question
+                    if qa_pair['question'].strip():
+                        qa_pairs.append(qa_pair)
+                        logger.debug("    Added QA pair: %.50s...", qa_pair['question'])
             else:
                 # No JSON found, treat as plain text
-                print(f"  No JSON found, treating as plain text")
-                qa_pair = {
-                    **metadata,
+                logger.debug("  No JSON found, treating as plain text")
+                qa_pair = metadata | {
                     'entry_index': entry_idx,
                     'qa_pair_index': 0,
                     'question': qa_entry.get('question', 'Unknown'),
@@ -167,7 +304,7 @@ class FixedQAExtractor:
                 }
                 qa_pairs.append(qa_pair)
         
-        print(f"\nTotal extracted QA pairs: {len(qa_pairs)}")
+        logger.debug("Total extracted QA pairs: %d", len(qa_pairs))
         return qa_pairs
     
     def display_qa_pairs(self, qa_pairs: List[Dict]):
@@ -203,13 +340,18 @@ class FixedQAExtractor:
         """Save QA pairs to JSON file"""
         try:
             with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(qa_pairs, f, indent=2, ensure_ascii=False)
+                f.write(_dumps(qa_pairs))
             print(f"✅ Saved {len(qa_pairs)} QA pairs to {filename}")
         except Exception as e:
             print(f"❌ Error saving to {filename}: {e}")
 
 def main():
     """Main function to test the extractor"""
+    parser = argparse.ArgumentParser(description="Extract QA pairs from a stored result")
+    parser.add_argument('--verbose', action='store_true', help="log per-entry extraction details")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    
     print("🚀 TESTING FIXED QA EXTRACTOR")
     print("="*80)
     
@@ -0,0 +1,44 @@
+import time
+
+from test import FixedQAExtractor, _json_objects
+
+
+def test_json_objects_after_unescaped_quote_in_malformed_object():
+    text = ('Answers: {"question": "Draw a 5" line", "answer": "done"} '
+            'and {"question": "Q2", "answer": "4"}')
+    assert _json_objects(text) == [{"question": "Q2", "answer": "4"}]
+
+
+def test_json_objects_after_brace_inside_prose_quote():
+    assert _json_objects('He said "hi {there" {"question":"d"}') == [{"question": "d"}]
+
+
+def test_json_objects_keeps_nested_objects_and_string_braces():
+    text = 'a {"q": "has } brace", "n": {"x": 1}} b {"r": "\\"{"}'
+    assert _json_objects(text) == [{"q": "has } brace", "n": {"x": 1}}, {"r": '"{'}]
+
+
+def test_json_objects_inside_unclosed_object():
+    assert _json_objects('{ broken {"question":"a"} x') == [{"question": "a"}]
+
+
+def test_json_objects_deeply_nested_unclosed_text():
+    # Deeper than the stdlib decoder's recursion limit
+    assert _json_objects('{"a": ' * 1200) == []
+
+
+def test_json_objects_scan_is_linear_on_unclosed_candidates():
+    # Every "{" here is a candidate that never closes
+    started = time.perf_counter()
+    assert _json_objects('{"x' * 40000) == []
+    assert time.perf_counter() - started < 1.0
+
+
+def test_extract_json_from_text_falls_back_to_embedded_objects():
+    extractor = FixedQAExtractor()
+    text = 'He is 5" tall. {"question": "Q1", "answer": "A1"} \\frac{1}{2}'
+    assert extractor.extract_json_from_text(text) == [{"question": "Q1", "answer": "A1"}]
+
+
+def test_extract_json_from_text_deeply_nested_unclosed_text():
+    assert FixedQAExtractor().extract_json_from_text('{"a": ' * 1200) == []